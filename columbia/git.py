@@ -11,16 +11,71 @@ try:
 except ImportError:
     from urlparse import urlparse
 
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+
+try:
+    from functools import cached_property
+except ImportError:
+    class cached_property(object):
+        """Minimal stand in for functools.cached_property (Python 3.8+)."""
+
+        def __init__(self, func):
+            self.func = func
+            self.__doc__ = func.__doc__
+
+        def __get__(self, instance, owner=None):
+            if instance is None:
+                return self
+            value = instance.__dict__[self.func.__name__] = self.func(instance)
+            return value
+
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait
+
 import collections
+import functools
 import hashlib
+import mmap
 import os
-
-import shutil
+import re
 import subprocess
+import sys
+import threading
+import weakref
+
+try:
+    import pygit2
+except ImportError:
+    pygit2 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
 
 
 GIT_BINARY = "/usr/bin/git"
 
+# On Python 3.8+ subprocess spawns children with posix_spawn instead of
+# fork+exec, but only when close_fds is off and no cwd is given. File
+# descriptors are non-inheritable by default since Python 3.4 so nothing
+# leaks into git.
+if sys.version_info >= (3, 8):
+    _SPAWN_OPTIONS = {"close_fds": False}
+else:
+    _SPAWN_OPTIONS = {}
+
+_HEADS = "refs/heads/"
+_TAGS = "refs/tags/"
+_REMOTE_HEADS = "refs/remotes/origin/"
+
 Worktree = collections.namedtuple(
     "Worktree",
     [
@@ -30,12 +85,84 @@ Worktree = collections.namedtuple(
     ]
 )
 
+# Matches the records of `git worktree list --porcelain` which have a branch
+# checked out. Bare and detached entries are skipped.
+_WORKTREE_RE = re.compile(
+    r"^worktree (?P<worktree>[^\n]+)\n"
+    r"HEAD (?P<HEAD>[^\n]+)\n"
+    r"branch (?P<branch>[^\n]+)$",
+    re.MULTILINE
+)
 
-def repo_url_hash_path_builder(working_directory, url):
-    """Returns a unique repo Path in the given working_directory based on a
-    two level hash of the repo URL.
+# A SHA-1 or SHA-256 object name.
+_SHA_RE = re.compile(r"^(?:[0-9a-f]{40}|[0-9a-f]{64})$")
+
+
+def _read_ref_file(path):
+    try:
+        with open(path, "rb") as f:
+            return f.read().decode("utf-8").strip()
+    except (IOError, OSError, UnicodeDecodeError):
+        return None
+
+
+def _find_packed_ref(git_dir, reference):
+    """Returns the object name of reference from the packed-refs file."""
+    try:
+        with open(os.path.join(git_dir, "packed-refs"), "rb") as f:
+            packed = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError, ValueError):
+        # ValueError is raised for an empty file, which can't be mapped.
+        return None
+
+    try:
+        # Lines are "<sha> <reference>".
+        end = packed.find(b" " + reference.encode("utf-8") + b"\n")
+        if end == -1:
+            return None
+        start = packed.rfind(b"\n", 0, end) + 1
+        return packed[start:end].decode("ascii")
+    finally:
+        packed.close()
+
+
+def _read_head(git_dir):
+    """Returns the commit HEAD points to by reading the files in git_dir.
+
+    Returns None when that can't be determined without git.
     """
-    url_hash = hashlib.md5(url.encode("utf-8")).hexdigest()
+    head = _read_ref_file(os.path.join(git_dir, "HEAD"))
+    if head is None:
+        return None
+
+    if head.startswith("ref: "):
+        reference = head[len("ref: "):]
+        if not reference.startswith(_HEADS):
+            return None
+        sha = _read_ref_file(os.path.join(git_dir, reference))
+        if sha is None:
+            sha = _find_packed_ref(git_dir, reference)
+    else:
+        # Detached HEAD.
+        sha = head
+
+    if sha is None or not _SHA_RE.match(sha):
+        return None
+    return sha
+
+
+def _md5_hexdigest(value):
+    return hashlib.md5(value.encode("utf-8")).hexdigest()
+
+
+if xxhash is not None:
+    def _hexdigest(value):
+        return xxhash.xxh128(value.encode("utf-8")).hexdigest()
+else:
+    _hexdigest = _md5_hexdigest
+
+
+def _url_hash_path(working_directory, url_hash):
     parent_directory = url_hash[:2]
     repository_directory = url_hash[2:]
     return Path(working_directory)\
@@ -43,32 +170,124 @@ def repo_url_hash_path_builder(working_directory, url):
         .joinpath(repository_directory)
 
 
+def repo_url_hash_path_builder(working_directory, url):
+    """Returns a unique repo Path in the given working_directory based on a
+    two level hash of the repo URL.
+    """
+    return _url_hash_path(working_directory, _hexdigest(url))
+
+
 def branch_hash_worktree_path_builder(branch):
     """Returns a relative path for a worktree based on the hash of the branch
     name.
     """
-    return hashlib.md5(branch.encode("utf-8")).hexdigest()
+    return _hexdigest(branch)
+
+
+def _unlink_all(paths):
+    for path in paths:
+        os.unlink(path)
+
+
+def _fast_rmtree(path, max_workers=4):
+    """Recursively delete a directory tree.
+
+    Files are unlinked in per-directory batches on a thread pool while the
+    tree is still being walked. Symlinks are removed, not followed, and like
+    shutil.rmtree a symlink as the root is refused.
+    """
+    if os.path.islink(path):
+        raise OSError("Cannot remove a symbolic link: '{0}'".format(path))
+
+    directories = []
+    pending = [path]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        while pending:
+            directory = pending.pop()
+            directories.append(directory)
+            files = []
+            for entry in scandir(directory):
+                if entry.is_dir(follow_symlinks=False):
+                    pending.append(entry.path)
+                else:
+                    files.append(entry.path)
+            if files:
+                futures.append(executor.submit(_unlink_all, files))
+        for future in futures:
+            # Re-raise any error from the workers.
+            future.result()
+    # Every directory was listed after its parent, so this removes children
+    # first.
+    for directory in reversed(directories):
+        os.rmdir(directory)
 
 
 class RepositoryLocation:
     def __init__(
             self, working_directory, repository_url,
             path_builder_func=repo_url_hash_path_builder):
-        url_hash = hashlib.md5(repository_url.encode("utf-8")).hexdigest()
+        # Everything derived from the URL is computed on first access.
         self.working_directory = working_directory
         self.url = repository_url
-        self.repository_url = urlparse(repository_url)
         self.worktree_path_builder = branch_hash_worktree_path_builder
-        # root_path is the container directory that will hold the core clone
-        # along with any worktrees created later.
-        self.root_path = path_builder_func(working_directory, repository_url)
-        # path is where the core clone is located. Defaults to a full hash
-        # of the repo URL.
-        self.path = self.root_path / url_hash
+        self._path_builder_func = path_builder_func
+
+    @cached_property
+    def repository_url(self):
+        return urlparse(self.url)
+
+    @cached_property
+    def _paths(self):
+        url_hash = _hexdigest(self.url)
+        root_path, path = self._build_paths(url_hash)
+        if _hexdigest is not _md5_hexdigest and not path.exists():
+            # Fall back to a clone made before xxhash was available.
+            legacy_hash = _md5_hexdigest(self.url)
+            legacy_root_path, legacy_path = self._build_paths(legacy_hash)
+            if legacy_path.exists():
+                return legacy_hash, legacy_root_path, legacy_path
+        return url_hash, root_path, path
+
+    def _build_paths(self, url_hash):
+        if self._path_builder_func is repo_url_hash_path_builder:
+            # Reuse the hash already computed for the URL.
+            root_path = _url_hash_path(self.working_directory, url_hash)
+        else:
+            root_path = self._path_builder_func(
+                self.working_directory, self.url)
+        return root_path, root_path / url_hash
+
+    @cached_property
+    def url_hash(self):
+        return self._paths[0]
+
+    @cached_property
+    def root_path(self):
+        """The container directory that will hold the core clone along with
+        any worktrees created later.
+        """
+        return self._paths[1]
+
+    @cached_property
+    def path(self):
+        """Where the core clone is located. Defaults to a full hash of the
+        repo URL.
+        """
+        return self._paths[2]
+
+    @cached_property
+    def _path_str(self):
+        # String forms of the paths, used for every git invocation.
+        return str(self.path)
+
+    @cached_property
+    def _root_str(self):
+        return str(self.root_path)
 
     @property
     def exists(self):
-        return self.path.exists()
+        return os.path.exists(self._path_str)
 
     def create(self):
         if self.exists:
@@ -78,19 +297,27 @@ class RepositoryLocation:
         return True
 
     def remove(self):
-        shutil.rmtree(str(self.root_path))
-        # Remove the parent directory if empty.
+        _fast_rmtree(self._root_str)
+        # The default layout nests root_path in a directory named after the
+        # first two characters of the hash, remove it if empty. Custom
+        # layouts may place root_path straight in the working directory,
+        # which must be left alone.
+        if self._path_builder_func is not repo_url_hash_path_builder:
+            return
         try:
-            self.path.parent.rmdir()
+            self.root_path.parent.rmdir()
         except OSError:
             # Parent directory isn't empty, do nothing.
             pass
 
     def fq_path(self, relative_path):
+        return os.path.join(self._path_str, relative_path)
+
+    def fq_pathlib(self, relative_path):
         return self.path / relative_path
 
     def path_exists(self, relative_path):
-        return self.fq_path(relative_path).exists()
+        return os.path.exists(self.fq_path(relative_path))
 
     def search(self, pattern):
         return self.path.glob(pattern)
@@ -104,6 +331,49 @@ class RepositoryError(Exception):
     """A generic container for errors generated by the git command."""
 
 
+class _CatFile(object):
+    """A `git cat-file` process owned by a single thread.
+
+    The process is stopped once the holder is garbage collected, which
+    happens when the owning thread exits and its thread local data is
+    dropped.
+    """
+
+    def __init__(self, args):
+        self.process = subprocess.Popen(
+            args=args,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            **_SPAWN_OPTIONS
+        )
+
+    def query(self, reference):
+        """Sends reference to the process and returns the header line of
+        the reply, which is empty if the process has died.
+        """
+        try:
+            self.process.stdin.write((reference + "\n").encode("utf-8"))
+            self.process.stdin.flush()
+        except (IOError, OSError):
+            return b""
+        return self.process.stdout.readline()
+
+    def close(self):
+        process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            process.stdin.close()
+        except (IOError, OSError):
+            # The process already died.
+            pass
+        process.wait()
+        process.stdout.close()
+
+    def __del__(self):
+        self.close()
+
+
 class Repository:
     def __init__(
             self, repository_location,
@@ -114,15 +384,50 @@ class Repository:
         self.bare = bare
 
         self.created = False
+        # Set once the repository is known to be ready, see ready.
+        self._ready_cached = False
+
+        # The subprocess call used by every git command, bound once as it
+        # never changes for the repository. See also _argv_prefix.
+        self._run = functools.partial(
+            subprocess.check_output,
+            universal_newlines=True,
+            **_SPAWN_OPTIONS
+        )
+
+        # Memoized reference listings, see _references().
+        self._ref_cache = {"heads": None, "tags": None}
+
+        # Long running `git cat-file` coprocesses and pygit2 handles. Neither
+        # can be shared between threads so every thread gets its own.
+        # The cat-file holders are kept alive by self._local only, the weak
+        # set lets close() reach the ones of other threads.
+        self._local = threading.local()
+        self._cat_files = weakref.WeakSet()
+        self._cat_lock = threading.Lock()
+        # Serializes clones of a repository shared by setup_repository.
+        self._clone_lock = threading.Lock()
 
         # Clone the repo on initialization. NOTE: the properties
         # accessed by the methods below need to be defined before calling
         # the methods.
-        if not self.ready and clone:
+        if clone and not self.ready:
             self.clone(self.bare)
 
+    @cached_property
+    def _argv_prefix(self):
+        # Built on first use so constructing a Repository doesn't force the
+        # location's paths to be computed.
+        return (self.binary, "-C", self.location._path_str)
+
     @property
     def ready(self):
+        # Only a positive result is kept: it is the one that costs a
+        # rev-parse for bare repositories and it holds until the location is
+        # removed.
+        if self._ready_cached:
+            return True
+
         if not self.location.exists:
             return False
 
@@ -131,49 +436,205 @@ class Repository:
                 self._git("rev-parse", ["--git-dir"])
             except subprocess.CalledProcessError:
                 return False
-
-            return True
         else:
             if not self.location.path_exists(".git"):
                 return False
 
+        self._ready_cached = True
         return True
 
-    def _git(self, command, arguments=None, cwd=None):
+    def _git_args(self, command, arguments=None, cwd=None):
+        # Target the directory with -C rather than changing the working
+        # directory of the child process.
         if cwd is None:
-            cwd = str(self.location.path)
-        if arguments is None:
-            arguments = []
-        args = [self.binary, command]
-        args.extend(arguments)
-        result = subprocess.check_output(
+            args = self._argv_prefix + (command,)
+        else:
+            args = (self.binary, "-C", cwd, command)
+        if arguments:
+            args += tuple(arguments)
+        return args
+
+    def _git(self, command, arguments=None, cwd=None):
+        return self._run(self._git_args(command, arguments, cwd))
+
+    def _git_stream(self, command, arguments=None, cwd=None):
+        """Like _git but yields the output line by line as it is read,
+        rather than buffering all of it.
+
+        Lines are yielded as bytes without the trailing newline.
+        """
+        args = self._git_args(command, arguments, cwd)
+        process = subprocess.Popen(
             args=args,
-            cwd=cwd,
-            universal_newlines=True
+            stdout=subprocess.PIPE,
+            **_SPAWN_OPTIONS
+        )
+        try:
+            for line in process.stdout:
+                yield line.rstrip(b"\n")
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode:
+            raise subprocess.CalledProcessError(returncode, args)
+
+    def _git_script(self, commands, cwd=None):
+        """Run a sequence of git commands through a single shell.
+
+        Each command is a list of arguments to git. Commands are chained
+        with && so the script stops at the first failure.
+        """
+        if cwd is None:
+            prefix = self._argv_prefix
+        else:
+            prefix = (self.binary, "-C", cwd)
+        script = " && ".join(
+            " ".join(quote(arg) for arg in prefix + tuple(command))
+            for command in commands
         )
+        result = self._run(("/bin/sh", "-c", script))
         return result
 
+    def _libgit2(self):
+        """Returns a pygit2 handle on the repository for the current thread.
+
+        Returns None when pygit2 isn't installed or the repository can't be
+        opened, callers then fall back to running git.
+        """
+        if pygit2 is None:
+            return None
+
+        handle = getattr(self._local, "libgit2", None)
+        if handle is None:
+            try:
+                handle = pygit2.Repository(self.location._path_str)
+            except (pygit2.GitError, KeyError):
+                return None
+            self._local.libgit2 = handle
+        return handle
+
+    def _cat_process(self, check=False, restart=False):
+        name = "cat_check" if check else "cat"
+        cat = getattr(self._local, name, None)
+        if cat is not None and restart:
+            cat.close()
+            cat = None
+        if cat is None:
+            mode = "--batch-check" if check else "--batch"
+            cat = _CatFile(self._git_args("cat-file", [mode]))
+            setattr(self._local, name, cat)
+            with self._cat_lock:
+                self._cat_files.add(cat)
+        return cat
+
+    def _cat_file(self, reference, check=False):
+        """Resolve a reference using a persistent `git cat-file` process.
+
+        Returns a (sha, kind, size, payload) tuple. The payload is None when
+        check is specified, in which case only the object header is read.
+        """
+        if "\n" in reference:
+            # cat-file reads one reference per line, a newline would send a
+            # second request and leave the replies out of step.
+            msg = "Invalid reference: '{0}'".format(reference)
+            raise RepositoryError(msg)
+
+        cat = self._cat_process(check)
+        line = cat.query(reference)
+        if not line:
+            # The process died, retry once with a fresh one.
+            cat = self._cat_process(check, restart=True)
+            line = cat.query(reference)
+            if not line:
+                raise RepositoryError("git cat-file exited unexpectedly")
+
+        header = line.decode("utf-8").rstrip("\n")
+        # Unknown objects get "<reference> missing" (or "ambiguous"). The
+        # reference may contain spaces so only the end of the line is
+        # reliable.
+        if header.endswith((" missing", " ambiguous")):
+            msg = "Unknown reference: '{0}'".format(reference)
+            raise RepositoryError(msg)
+
+        fields = header.split(" ")
+        if len(fields) != 3 or not fields[2].isdigit():
+            msg = "Unexpected reply from git cat-file: '{0}'".format(header)
+            raise RepositoryError(msg)
+
+        sha, kind, size = fields[0], fields[1], int(fields[2])
+        if check:
+            return sha, kind, size, None
+
+        payload = cat.process.stdout.read(size)
+        # Consume the newline trailing the object contents.
+        cat.process.stdout.read(1)
+        return sha, kind, size, payload
+
+    def close(self):
+        """Terminate any `git cat-file` processes started by the
+        repository.
+        """
+        with self._cat_lock:
+            cats = list(self._cat_files)
+            self._cat_files = weakref.WeakSet()
+        for cat in cats:
+            cat.close()
+        self._local = threading.local()
+
+    def __del__(self):
+        # __init__ may not have completed.
+        if getattr(self, "_cat_files", None) is not None:
+            self.close()
+
     def _ready_target_location(self):
         self.created = self.location.create()
 
     def _remove_target_location(self):
         self.location.remove()
+        self._ready_cached = False
 
     def _hard_reset(self):
         self._git("reset", ["--hard", "HEAD"])
 
-    def _checkout(self, reference):
-        self._git("checkout", [reference])
-
     def _pull(self, cwd=None):
         self._git("pull", cwd=cwd)
 
     def _split_branch_name(self, reference):
-        return reference.split("refs/heads/")[1]
+        if reference.startswith(_HEADS):
+            return reference[len(_HEADS):]
+        return reference
+
+    def _references(self, kind, prefix, refresh=False):
+        """Returns the names of the local references under prefix.
+
+        Results are memoized per kind until refresh is specified or the
+        cache is invalidated.
+        """
+        if refresh or self._ref_cache[kind] is None:
+            names = []
+            for reference in self._reference_names(prefix):
+                name = reference[len(prefix):]
+                if name != "HEAD":
+                    names.append(name)
+            self._ref_cache[kind] = names
+        return list(self._ref_cache[kind])
+
+    def _reference_names(self, prefix):
+        handle = self._libgit2()
+        if handle is not None:
+            # Sorted to match the order of for-each-ref.
+            return sorted(r for r in handle.references if r.startswith(prefix))
+
+        lines = self._git_stream(
+            "for-each-ref", ["--format=%(refname)", prefix])
+        return (line.decode("utf-8") for line in lines)
+
+    def _invalidate_references(self):
+        self._ref_cache = {"heads": None, "tags": None}
 
     def clone(self, bare=False):
         self._ready_target_location()
-        args = [self._url, str(self.location.path)]
+        args = [self._url, self.location._path_str]
         if bare:
             args.insert(0, "--bare")
         try:
@@ -189,6 +650,7 @@ class Repository:
     def update(self):
         """Pull the latest changes from remote."""
         self._pull()
+        self._invalidate_references()
 
     def update_to(self, reference):
         """Make a given reference active.
@@ -197,8 +659,8 @@ class Repository:
 
         The reference can be any git reference (commit, branch, tag, ...).
         """
-        self._checkout(reference)
-        self._pull()
+        self._git_script([["checkout", reference], ["pull"]])
+        self._invalidate_references()
 
     def export(self, destination):
         """Export all the files of the current working copy to the given
@@ -214,103 +676,240 @@ class Repository:
             ["-a", "-f", "--prefix={0}".format(destination)]
         )
 
+    def export_linked(self, destination, keep_git=False):
+        """Export all the files of HEAD to the given destination by adding a
+        detached worktree there.
+
+        Unlike export this works for bare repositories and the checkout shares
+        the object store of the repository instead of copying anything from
+        it. Unless keep_git is specified the worktree is unlinked from the
+        repository afterwards, leaving only the files. The destination must
+        not exist or be empty.
+        """
+        destination = os.path.abspath(destination)
+        self._git("worktree", ["add", "--detach", destination, "HEAD"])
+        if not keep_git:
+            os.unlink(os.path.join(destination, ".git"))
+            # Drop the administrative files of the now unlinked worktree.
+            self._git("worktree", ["prune"])
+
+    def read(self, reference):
+        """Returns the raw contents of the object named by reference.
+
+        The reference can be any git object name (HEAD, v1.0,
+        master:README.rst, ...).
+        """
+        _, _, _, payload = self._cat_file(reference)
+        return payload
+
     def latest_commit(self, cwd=None):
+        if cwd is None:
+            handle = self._libgit2()
+            if handle is not None:
+                try:
+                    return str(handle.head.target)
+                except pygit2.GitError:
+                    # E.g. an unborn HEAD, let git report it the same way
+                    # as without pygit2.
+                    pass
+
+            sha, _, _, _ = self._cat_file("HEAD", check=True)
+            return sha
+
         result = self._git("rev-parse", ["--verify", "HEAD"], cwd=cwd)
         return result.strip()
 
-    def branches(self):
-        result = self._git("ls-remote", ["--heads"])
-        if not result:
-            return []
+    def latest_commit_fast(self):
+        """Like latest_commit but reads HEAD straight from the repository
+        files.
 
-        branches = result.strip().split("\n")
-        branches = [self._split_branch_name(b) for b in branches]
-        return branches
+        Anything that can't be resolved that way, such as a non-branch
+        symbolic ref or a .git file, falls back to latest_commit.
+        """
+        if self.bare:
+            git_dir = self.location._path_str
+        else:
+            git_dir = self.location.fq_path(".git")
+        sha = _read_head(git_dir)
+        if sha is None:
+            return self.latest_commit()
+        return sha
+
+    def branches(self, refresh=False):
+        """Returns the names of the branches known from the remote.
+
+        The listing is read from the local references and memoized, specify
+        refresh to bypass the cache.
+        """
+        # A bare clone maps the remote branches directly onto refs/heads,
+        # while a regular clone tracks them under refs/remotes/origin.
+        if self.bare:
+            prefix = _HEADS
+        else:
+            prefix = _REMOTE_HEADS
+        return self._references("heads", prefix, refresh=refresh)
 
     @property
     def active_branch(self):
+        handle = self._libgit2()
+        if handle is not None and not (
+                handle.head_is_detached or handle.head_is_unborn):
+            return handle.head.shorthand
+
         result = self._git("symbolic-ref", ["HEAD"])
         if not result:
             return None
 
         branch = result.strip()
-        return branch.split("refs/heads/")[1]
+        return self._split_branch_name(branch)
 
-    def tags(self):
-        result = self._git("ls-remote", ["--tags"])
-        if not result:
-            return []
+    def tags(self, refresh=False):
+        """Returns the names of the tags.
 
-        tags = result.strip().split("\n")
-        tags = [t.split("refs/tags/")[1] for t in tags]
-        return tags
+        The listing is read from the local references and memoized, specify
+        refresh to bypass the cache.
+        """
+        return self._references("tags", _TAGS, refresh=refresh)
+
+    def snapshot(self):
+        """Returns the head commit, active branch, branches and tags of the
+        repository in a dict.
+
+        The queries are independent so they run concurrently.
+        """
+        queries = {
+            "branch": lambda: self.active_branch,
+            "branches": self.branches,
+            "tags": self.tags,
+        }
+        with ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            futures = dict(
+                (executor.submit(query), key)
+                for key, query in queries.items()
+            )
+            # Resolve HEAD on this thread so the cat-file process is reused.
+            result = {"head": self.latest_commit()}
+            for future in as_completed(futures):
+                result[futures[future]] = future.result()
+        return result
 
     def worktrees(self, branch_name=None):
         result = self._git("worktree", ["list", "--porcelain"])
-        if not result:
-            return []
-
-        worktrees = []
-        current_wt = {}
-        for line in result.strip().splitlines():
-            if not line:
-                # Line is empty, this a worktree boundry
-                worktrees.append(current_wt)
-                current_wt = {}
-                continue
-
-            key, value = line.split(" ")
-            current_wt[key] = value
-        worktrees.append(current_wt)
-
-        tuples = []
-        for d in worktrees:
-            wt = Worktree(
-                path=d["worktree"],
-                head=d["HEAD"],
-                branch=self._split_branch_name(d["branch"])
+        tuples = [
+            Worktree(
+                path=m.group("worktree"),
+                head=m.group("HEAD"),
+                branch=self._split_branch_name(m.group("branch"))
             )
+            for m in _WORKTREE_RE.finditer(result)
+        ]
+        if branch_name is None:
+            return tuples
+
+        for wt in tuples:
             if branch_name == wt.branch:
                 return wt
-            tuples.append(wt)
 
-        if branch_name is not None:
-            # If branch_name was specified but we got here without finding and
-            # returning it then it is invalid.
-            msg = "Unknown worktree: '{0}'".format(branch_name)
-            raise RepositoryError(msg)
-        return tuples
+        # If branch_name was specified but we got here without finding and
+        # returning it then it is invalid.
+        msg = "Unknown worktree: '{0}'".format(branch_name)
+        raise RepositoryError(msg)
 
-    def add_worktree(self, branch_name):
-        path = str(self.location.worktree_path(branch_name))
+    def _worktree_path(self, branch_name):
+        return os.path.join(
+            self.location._root_str,
+            self.location.worktree_path_builder(branch_name)
+        )
+
+    def _worktree_start_point(self, branch_name):
         # TODO: Make references to origin more flexible.
-        self._git(
-            "worktree",
+        return "origin/{0}".format(branch_name)
+
+    def add_worktree(self, branch_name):
+        path = self._worktree_path(branch_name)
+        result = self._git_script([
             [
+                "worktree",
                 "add",
                 "-b",
                 branch_name,
                 path,
-                "origin/{0}".format(branch_name)
-            ]
-        )
-        head = self.latest_commit(cwd=path)
+                self._worktree_start_point(branch_name)
+            ],
+            ["-C", path, "rev-parse", "--verify", "HEAD"],
+        ])
+        head = result.strip().splitlines()[-1]
+        self._invalidate_references()
         return Worktree(path=path, head=head, branch=branch_name)
 
+    def add_worktrees(self, branch_names):
+        """Add a worktree for each of the given branches.
+
+        The worktrees are registered one after the other, git doesn't
+        support concurrent `worktree add` in the same repository, and their
+        files are then checked out concurrently. Returns a list of Worktree
+        tuples in the order of branch_names.
+        """
+        branch_names = list(branch_names)
+        if not branch_names:
+            return []
+
+        added = []
+        failures = []
+        for branch_name in branch_names:
+            try:
+                self._git(
+                    "worktree",
+                    [
+                        "add",
+                        "--no-checkout",
+                        "-b",
+                        branch_name,
+                        self._worktree_path(branch_name),
+                        self._worktree_start_point(branch_name)
+                    ]
+                )
+            except subprocess.CalledProcessError as exc:
+                failures.append(exc)
+            else:
+                added.append(branch_name)
+        self._invalidate_references()
+
+        def checkout(branch_name):
+            path = self._worktree_path(branch_name)
+            self._git("reset", ["--hard", "--quiet"], cwd=path)
+
+        if added:
+            workers = min(8, len(added))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(checkout, b) for b in added]
+                wait(futures)
+            for future in futures:
+                # Re-raise the first checkout failure, if any.
+                future.result()
+        if failures:
+            raise failures[0]
+
+        # One listing gives the heads of all the new worktrees.
+        worktrees = dict((wt.branch, wt) for wt in self.worktrees())
+        return [worktrees[b] for b in branch_names]
+
     def remove_worktree(self, branch_name):
         wt = self.worktrees(branch_name)
         path = wt.path
         # Remove the worktree off the file system.
-        shutil.rmtree(path)
+        _fast_rmtree(path)
         # Force git to update the worktrees now.
         self._git("worktree", ["prune"])
         # Remove the local branch that was created.
         self._git("branch", ["-d", branch_name])
+        self._invalidate_references()
 
     def update_worktree(self, branch_name):
         wt = self.worktrees(branch_name)
         path = wt.path
         self._pull(cwd=path)
+        self._invalidate_references()
 
     def clean(self, thorough=False):
         """Cleans the current working copy of the repository.
@@ -320,7 +919,12 @@ class Repository:
         reset to HEAD.
         """
         if thorough:
+            # The repository is gone, stop handing it out and shut down the
+            # processes still reading from it.
+            _forget_repository(self)
+            self.close()
             self._remove_target_location()
+            self._invalidate_references()
         else:
             self._hard_reset()
 
@@ -330,15 +934,49 @@ class Repository:
         """
         return self.location.fq_path(relative_path)
 
+    def fq_pathlib(self, relative_path):
+        """Like fq_path but returns a Path."""
+        return self.location.fq_pathlib(relative_path)
+
     def search(self, pattern):
         """Returns a list of file paths matching the given pattern."""
         return self.location.search(pattern)
 
 
+# Repositories handed out by setup_repository.
+_REPO_CACHE = {}
+_REPO_CACHE_LOCK = threading.Lock()
+
+
+def _forget_repository(repository):
+    with _REPO_CACHE_LOCK:
+        for key, cached in list(_REPO_CACHE.items()):
+            if cached is repository:
+                del _REPO_CACHE[key]
+
+
 def setup_repository(
         working_directory, url,
         binary=GIT_BINARY, bare=False, clone=False):
     """A helper function to construct a Repository with a RepositoryLocation.
+
+    Repositories are shared, asking for the same one again returns the
+    existing instance until it is removed with clean(thorough=True). Shared
+    instances are never evicted otherwise, call close() on one to stop its
+    `git cat-file` processes once it is no longer needed.
     """
-    location = RepositoryLocation(working_directory, url)
-    return Repository(location, binary, bare=bare, clone=clone)
+    key = (os.path.abspath(working_directory), url, binary, bare)
+    with _REPO_CACHE_LOCK:
+        repository = _REPO_CACHE.get(key)
+        if repository is None:
+            location = RepositoryLocation(working_directory, url)
+            repository = Repository(location, binary, bare=bare)
+            _REPO_CACHE[key] = repository
+
+    # Clone outside of the cache lock so other repositories aren't held up.
+    if clone and not repository.ready:
+        with repository._clone_lock:
+            # Another caller may have cloned while we waited.
+            if not repository.ready:
+                repository.clone(bare)
+    return repository
@@ -19,7 +19,13 @@ setup(
     namespace_packages=["columbia"],
     zip_safe=False,
     install_requires=[
+        "futures; python_version < '3'",
+        "scandir; python_version < '3.5'",
     ],
+    extras_require={
+        "pygit2": ["pygit2"],
+        "xxhash": ["xxhash"],
+    },
     classifiers=[
         "Development Status :: 3 - Alpha",
         "Intended Audience :: Developers",
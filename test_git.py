@@ -1,33 +1,461 @@
+import hashlib
+import os
 import pytest
 import shutil
+import stat
+import subprocess
 import tempfile
+import threading
+import time
 
 from columbia import git
 
 
+def run_git(cwd, *args):
+    result = subprocess.check_output(
+        [git.GIT_BINARY, "-C", cwd] + list(args),
+        universal_newlines=True
+    )
+    return result.strip()
+
+
+def commit(path, message):
+    run_git(
+        path,
+        "-c", "user.name=Columbia", "-c", "user.email=columbia@example.com",
+        "commit", "-q", "--allow-empty", "-m", message
+    )
+    return run_git(path, "rev-parse", "HEAD")
+
+
+def make_remote(path, branches=("feature",), tags=("v1",)):
+    """Creates a repository at path with a single commit on master along with
+    the given branches and tags. Returns the sha of the commit.
+    """
+    subprocess.check_call([git.GIT_BINARY, "init", "-q", path])
+    run_git(path, "symbolic-ref", "HEAD", "refs/heads/master")
+    with open("{0}/README".format(path), "w") as f:
+        f.write("columbia\n")
+    run_git(path, "add", "README")
+    head = commit(path, "Initial commit")
+    for branch in branches:
+        run_git(path, "branch", branch)
+    for tag in tags:
+        run_git(path, "tag", tag)
+    return head
+
+
 @pytest.fixture(scope="module")
-def tempdirectory():
+def tempdirectory(request):
     testdir = tempfile.mkdtemp()
 
     def fin():
         shutil.rmtree(testdir)
 
+    request.addfinalizer(fin)
     return testdir
 
 
 @pytest.fixture(scope="module")
-def repo(tempdirectory):
+def remote(tempdirectory):
+    path = "{0}/remote".format(tempdirectory)
+    head = make_remote(path)
+    return path, head
+
+
+@pytest.fixture(scope="module")
+def repo(tempdirectory, remote):
+    url, _ = remote
     repo = git.setup_repository(
         tempdirectory,
-        "https://github.com/jpaidoussi/columbia-git.git",
-        binary="/usr/local/bin/git"
+        url,
+        binary=git.GIT_BINARY,
+        clone=True
     )
     return repo
 
 
+@pytest.fixture
+def fresh_repo(tmpdir, remote):
+    url, _ = remote
+    location = git.RepositoryLocation(str(tmpdir), url)
+    return git.Repository(location, git.GIT_BINARY, clone=True)
+
+
+def no_fallback(cwd=None):
+    raise AssertionError("latest_commit should not have been called")
+
+
+def test_repository_construction_is_lazy(tmpdir, remote):
+    url, _ = remote
+    location = git.RepositoryLocation(str(tmpdir), url)
+    git.Repository(location, git.GIT_BINARY)
+    assert "_paths" not in vars(location)
+
+
 def test_repository_ready(repo):
     assert repo.ready is True
 
 
 def test_repository_branches(repo):
-    assert repo.branches() == ["master"]
+    assert repo.branches() == ["feature", "master"]
+
+
+def test_repository_snapshot(repo, remote):
+    _, head = remote
+    snapshot = repo.snapshot()
+    assert snapshot == {
+        "head": head,
+        "branch": "master",
+        "branches": ["feature", "master"],
+        "tags": ["v1"],
+    }
+
+
+def test_repository_latest_commit_fast(repo):
+    assert repo.latest_commit_fast() == repo.latest_commit()
+
+
+def test_repository_latest_commit_fast_packed(fresh_repo, remote, monkeypatch):
+    _, head = remote
+    fresh_repo._git("pack-refs", ["--all"])
+    assert not fresh_repo.location.path_exists(".git/refs/heads/master")
+    monkeypatch.setattr(fresh_repo, "latest_commit", no_fallback)
+    assert fresh_repo.latest_commit_fast() == head
+
+
+def test_repository_latest_commit_fast_detached(
+        fresh_repo, remote, monkeypatch):
+    _, head = remote
+    fresh_repo._git("checkout", ["-q", "--detach"])
+    monkeypatch.setattr(fresh_repo, "latest_commit", no_fallback)
+    assert fresh_repo.latest_commit_fast() == head
+
+
+def test_repository_latest_commit_fast_git_file(
+        fresh_repo, remote, tmpdir, monkeypatch):
+    _, head = remote
+    # Move the git directory out and leave a .git file pointing to it.
+    git_dir = str(tmpdir.join("gitdir"))
+    os.rename(fresh_repo.fq_path(".git"), git_dir)
+    with open(fresh_repo.fq_path(".git"), "w") as f:
+        f.write("gitdir: {0}\n".format(git_dir))
+
+    calls = []
+    latest_commit = fresh_repo.latest_commit
+
+    def fallback(cwd=None):
+        calls.append(cwd)
+        return latest_commit(cwd=cwd)
+
+    monkeypatch.setattr(fresh_repo, "latest_commit", fallback)
+    assert fresh_repo.latest_commit_fast() == head
+    assert calls == [None]
+
+
+def test_repository_read(repo):
+    assert repo.read("HEAD:README") == b"columbia\n"
+
+
+def test_repository_read_missing(repo):
+    with pytest.raises(git.RepositoryError):
+        repo.read("HEAD:missing")
+    with pytest.raises(git.RepositoryError):
+        repo.read("HEAD:a b")
+    # The process is still in step after the failures.
+    assert repo.read("HEAD:README") == b"columbia\n"
+
+
+def test_repository_read_rejects_newline(repo):
+    with pytest.raises(git.RepositoryError):
+        repo.read("HEAD\nv1")
+    assert repo.read("HEAD:README") == b"columbia\n"
+
+
+def test_repository_cat_file_ends_with_thread(repo):
+    # read() always goes through cat-file, even when pygit2 is installed.
+    processes = []
+
+    def resolve():
+        repo.read("HEAD:README")
+        processes.append(repo._local.cat.process)
+
+    for _ in range(3):
+        thread = threading.Thread(target=resolve)
+        thread.start()
+        thread.join()
+
+    assert [p.poll() for p in processes] == [0, 0, 0]
+    live = [cat.process for cat in repo._cat_files]
+    assert not any(p in live for p in processes)
+
+
+def test_repository_cat_file_restarts(repo):
+    assert repo.read("HEAD:README") == b"columbia\n"
+    cat = repo._local.cat
+    cat.process.kill()
+    cat.process.wait()
+    assert repo.read("HEAD:README") == b"columbia\n"
+    assert repo._local.cat is not cat
+
+
+def test_setup_repository_shared(tmpdir, remote, monkeypatch):
+    url, head = remote
+    working_directory = str(tmpdir)
+    results = []
+    clones = []
+    clone = git.Repository.clone
+
+    def slow_clone(self, bare=False):
+        # Widen the window in which concurrent callers could clone too.
+        clones.append(bare)
+        time.sleep(0.1)
+        clone(self, bare)
+
+    monkeypatch.setattr(git.Repository, "clone", slow_clone)
+
+    def setup():
+        results.append(git.setup_repository(
+            working_directory, url, binary=git.GIT_BINARY, clone=True))
+
+    threads = [threading.Thread(target=setup) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    repository = results[0]
+    assert len(results) == 4
+    assert len(clones) == 1
+    assert all(r is repository for r in results)
+    assert repository.latest_commit() == head
+
+    repository.clean(thorough=True)
+    other = git.setup_repository(working_directory, url, binary=git.GIT_BINARY)
+    assert other is not repository
+    assert other.ready is False
+
+
+def test_fast_rmtree(tmpdir):
+    outside = tmpdir.mkdir("outside")
+    outside.join("keep").write("keep")
+    tree = tmpdir.mkdir("tree")
+    tree.mkdir("a").mkdir("b").join("file").write("file")
+    # Git writes its objects read-only.
+    objects = tree.mkdir("objects").mkdir("ab")
+    obj = objects.join("cdef")
+    obj.write("object")
+    os.chmod(str(obj), stat.S_IRUSR)
+    os.symlink(str(outside), str(tree.join("a").join("link")))
+    os.symlink(str(outside.join("keep")), str(tree.join("file-link")))
+
+    git._fast_rmtree(str(tree))
+
+    assert not tree.check()
+    assert outside.join("keep").read() == "keep"
+
+    # A symlink as the root is refused without touching its target.
+    root_link = tmpdir.join("root-link")
+    os.symlink(str(outside), str(root_link))
+    with pytest.raises(OSError):
+        git._fast_rmtree(str(root_link))
+    assert outside.join("keep").read() == "keep"
+    assert root_link.check(link=1)
+
+
+def test_repository_location_remove(tmpdir, remote):
+    url, _ = remote
+    working_directory = str(tmpdir)
+
+    location = git.RepositoryLocation(working_directory, url)
+    location.create()
+    location.remove()
+    # The empty two level hash directory is cleaned up as well.
+    assert os.listdir(working_directory) == []
+
+    def builder(working_directory, url):
+        return git.Path(working_directory) / "custom"
+
+    location = git.RepositoryLocation(
+        working_directory, url, path_builder_func=builder)
+    location.create()
+    location.remove()
+    assert os.path.isdir(working_directory)
+
+
+def test_repository_worktrees_skips_bare_and_detached(tmpdir, remote):
+    url, head = remote
+    location = git.RepositoryLocation(str(tmpdir.mkdir("clones")), url)
+    repository = git.Repository(
+        location, git.GIT_BINARY, bare=True, clone=True)
+    path = str(tmpdir.join("feature"))
+    repository._git("worktree", ["add", path, "feature"])
+    repository.export_linked(str(tmpdir.join("export")), keep_git=True)
+    porcelain = repository._git("worktree", ["list", "--porcelain"])
+    assert "\nbare\n" in porcelain
+    assert "\ndetached\n" in porcelain
+
+    assert repository.worktrees() == [
+        git.Worktree(path=path, head=head, branch="feature"),
+    ]
+
+
+def test_repository_add_worktrees(tmpdir):
+    url = str(tmpdir.join("remote"))
+    branches = ["b1", "b2", "b3", "b4"]
+    head = make_remote(url, branches=branches + ["c1"], tags=())
+    location = git.RepositoryLocation(str(tmpdir.mkdir("clones")), url)
+    repository = git.Repository(location, git.GIT_BINARY, clone=True)
+
+    worktrees = repository.add_worktrees(branches)
+    assert [wt.branch for wt in worktrees] == branches
+    assert [wt.head for wt in worktrees] == [head] * len(branches)
+    for wt in worktrees:
+        assert sorted(os.listdir(wt.path)) == [".git", "README"]
+        assert run_git(wt.path, "status", "--porcelain") == ""
+    for branch in branches:
+        upstream = repository._git(
+            "rev-parse", ["--abbrev-ref", "{0}@{{upstream}}".format(branch)])
+        assert upstream.strip() == "origin/{0}".format(branch)
+
+    # The branch that could be added is still tracked when another fails.
+    with pytest.raises(subprocess.CalledProcessError):
+        repository.add_worktrees(["c1", "missing"])
+    upstream = repository._git("rev-parse", ["--abbrev-ref", "c1@{upstream}"])
+    assert upstream.strip() == "origin/c1"
+    assert repository.worktrees("c1").head == head
+
+
+def test_setup_repository_normalizes_working_directory(
+        tmpdir, remote, monkeypatch):
+    url, _ = remote
+    tmpdir.mkdir("wd")
+    monkeypatch.chdir(tmpdir)
+    relative = git.setup_repository("wd", url, binary=git.GIT_BINARY)
+    absolute = git.setup_repository(
+        str(tmpdir.join("wd")), url, binary=git.GIT_BINARY)
+    assert relative is absolute
+
+
+def test_repository_location_legacy_md5(tmpdir, remote, monkeypatch):
+    url, _ = remote
+    working_directory = str(tmpdir)
+    # Clone with the MD5 layout.
+    monkeypatch.setattr(git, "_hexdigest", git._md5_hexdigest)
+    legacy = git.Repository(
+        git.RepositoryLocation(working_directory, url),
+        git.GIT_BINARY,
+        clone=True
+    )
+
+    # Switch to another hash, as when xxhash is installed.
+    def hexdigest(value):
+        return hashlib.sha256(value.encode("utf-8")).hexdigest()[:32]
+
+    monkeypatch.setattr(git, "_hexdigest", hexdigest)
+    location = git.RepositoryLocation(working_directory, url)
+    assert location.path == legacy.location.path
+    assert location.url_hash == git._md5_hexdigest(url)
+
+    other = git.RepositoryLocation(working_directory, url + "-other")
+    assert other.url_hash == hexdigest(url + "-other")
+
+
+def test_repository_latest_commit_unborn(tmpdir):
+    location = git.RepositoryLocation(str(tmpdir), "unborn")
+    location.create()
+    subprocess.check_call([git.GIT_BINARY, "init", "-q", location._path_str])
+    repository = git.Repository(location, git.GIT_BINARY)
+    with pytest.raises(git.RepositoryError):
+        repository.latest_commit()
+
+
+def test_repository_libgit2(fresh_repo, remote, monkeypatch):
+    pytest.importorskip("pygit2")
+    _, head = remote
+    assert fresh_repo._libgit2() is not None
+
+    def no_git(*args, **kwargs):
+        raise AssertionError("git should not have been run")
+
+    monkeypatch.setattr(fresh_repo, "_git", no_git)
+    monkeypatch.setattr(fresh_repo, "_git_stream", no_git)
+    monkeypatch.setattr(fresh_repo, "_cat_file", no_git)
+    assert fresh_repo.latest_commit() == head
+    assert fresh_repo.active_branch == "master"
+    assert fresh_repo.branches() == ["feature", "master"]
+    assert fresh_repo.tags() == ["v1"]
+
+
+@pytest.fixture
+def diverged_remote(tmpdir):
+    """A remote whose feature branch is one commit ahead of master."""
+    path = str(tmpdir.join("diverged"))
+    make_remote(path)
+    run_git(path, "checkout", "-q", "feature")
+    feature_head = commit(path, "Feature commit")
+    run_git(path, "checkout", "-q", "master")
+    return path, feature_head
+
+
+def test_repository_update_to(tmpdir, diverged_remote):
+    url, feature_head = diverged_remote
+    location = git.RepositoryLocation(str(tmpdir.mkdir("clones")), url)
+    repository = git.Repository(location, git.GIT_BINARY, clone=True)
+    repository.update_to("feature")
+    assert repository.active_branch == "feature"
+    assert repository.latest_commit() == feature_head
+
+
+def test_repository_add_worktree(tmpdir, diverged_remote):
+    url, feature_head = diverged_remote
+    location = git.RepositoryLocation(str(tmpdir.mkdir("clones")), url)
+    repository = git.Repository(location, git.GIT_BINARY, clone=True)
+    wt = repository.add_worktree("feature")
+    assert wt.head == feature_head
+    assert wt == repository.worktrees("feature")
+
+
+def test_repository_reference_cache(tmpdir):
+    url = str(tmpdir.join("remote"))
+    make_remote(url)
+    location = git.RepositoryLocation(str(tmpdir.mkdir("clones")), url)
+    repository = git.Repository(location, git.GIT_BINARY, clone=True)
+    assert repository.branches() == ["feature", "master"]
+    assert repository.tags() == ["v1"]
+
+    # A fetch behind the repository's back isn't seen until refreshed.
+    run_git(url, "branch", "fetched")
+    repository._git("fetch", ["--quiet"])
+    assert repository.branches() == ["feature", "master"]
+    assert repository.branches(refresh=True) == [
+        "feature", "fetched", "master"]
+
+    # update() invalidates the cache.
+    run_git(url, "branch", "updated")
+    repository.update()
+    assert "updated" in repository.branches()
+
+    # update_to() does as well.
+    run_git(url, "branch", "updated-to")
+    repository.update_to("master")
+    assert "updated-to" in repository.branches()
+
+    # And so do the worktree operations.
+    assert repository.tags() == ["v1"]
+    run_git(url, "tag", "v2")
+    repository._git("fetch", ["--quiet", "--tags"])
+    assert repository.tags() == ["v1"]
+    repository.add_worktree("feature")
+    assert repository.tags() == ["v1", "v2"]
+
+
+def test_repository_export_linked(fresh_repo, tmpdir):
+    destination = str(tmpdir.join("export"))
+    fresh_repo.export_linked(destination)
+    assert os.listdir(destination) == ["README"]
+    listing = fresh_repo._git("worktree", ["list", "--porcelain"])
+    assert destination not in listing
+    # Pruning drops the administrative files of the unlinked worktree.
+    admin = fresh_repo.fq_path(".git/worktrees")
+    assert not os.path.exists(admin) or os.listdir(admin) == []